@@ -44,12 +44,29 @@ options:
       type: str
       choices: [basejail, thickjail, template, present, cloned, started,
                 stopped, restarted, fetched, exec, pkg, exists, absent,
-                set, facts]
+                set, facts, exported, imported, stats, updated, pooled, allocated,
+                reconciled]
       default: facts
     name:
       description:
           - I(name) of the jail (former uuid).
       type: str
+    names:
+      description:
+          - I(names) of the jails. Set I(properties) of all of them by I(state=set) in one pass.
+            Mutually exclusive with I(name).
+      type: list
+      elements: str
+    native:
+      description:
+          - Write I(properties) of I(state=set) directly to C(<iocroot>/jails/<name>/config.json)
+            instead of running C(iocage get) and C(iocage set) per jail. The file is replaced
+            atomically. Only the keys that already exist in the file are written.
+          - A jail falls back to C(iocage set) if it is running and a property needs to be applied
+            at runtime, if a property is not in the file or is applied by iocage to ZFS or the
+            datasets (e.g. I(quota), I(release), I(template)), or if the file can't be read.
+      type: bool
+      default: False
     pkglist:
       description:
           - Path to a JSON file containing packages to install. Only applicable when creating a jail.
@@ -84,6 +101,27 @@ options:
         - Update the fetch to the latest patch level.
       type: bool
       default: False
+    concurrency:
+      description:
+        - Maximal number of jails updated in parallel by I(state=updated), or of independent
+          branches executed in parallel by I(state=reconciled).
+      type: int
+      default: 4
+    spec:
+      description:
+        - Complete desired state of the host. Required by I(state=reconciled).
+        - I(releases) is a list of releases.
+        - I(templates) and I(jails) are dictionaries of templates and jails by name. Each of them
+          may have the keys I(release), I(clone_from), I(pkglist), I(properties), and I(state)
+          (C(started) or C(stopped)). I(release) defaults to the option I(release). Templates
+          can't be C(started).
+      type: dict
+    prune:
+      description:
+        - Destroy the jails not listed in I(spec) by I(state=reconciled). Templates are kept.
+          The module fails if I(spec) has no jails.
+      type: bool
+      default: False
     components:
       description:
         - Uses a local file directory for the root directory instead
@@ -91,6 +129,115 @@ options:
       type: list
       elements: path
       aliases: [files, component]
+    image:
+      description:
+        - Path to the image (zip file created by C(iocage export)) of the jail I(name).
+          Used by I(state=imported). If not specified the newest image of I(name)
+          in I(image_dir) is used.
+        - The base name of the image must start with C(<name>_).
+      type: path
+    image_dir:
+      description:
+        - Local directory of the images. Exported images are copied into this directory.
+        - Defaults to the directory C(images) in the iocage root.
+      type: path
+    output_file:
+      description:
+        - Write stdout and stderr of the command I(cmd) to the file I(output_file) on the host
+          instead of keeping them in memory. Only the last I(output_tail) lines are returned
+          in B(stdout). Applicable to I(state=exec) and I(state=pkg).
+        - The file is written while the command runs. When the task runs with C(async) the
+          progress can be followed by reading the file.
+      type: path
+    output_tail:
+      description:
+        - Number of the last lines of I(output_file) returned in B(stdout). Must not be negative.
+        - The lines are read backwards from the end of the file, at most 1 MiB. Carriage returns
+          (e.g. of progress bars) also end a line.
+      type: int
+      default: 20
+    pool:
+      description:
+        - Name of the pool of pre-cloned jails of the template I(clone_from). The members of
+          the pool are named C(<pool>_<n>).
+        - Defaults to C(<clone_from>_pool).
+      type: str
+    pool_size:
+      description:
+        - Number of members of the pool kept by I(state=pooled) and I(state=allocated).
+      type: int
+      default: 1
+    pool_started:
+      description:
+        - Start the members of the pool.
+      type: bool
+      default: False
+    pool_properties:
+      description:
+        - I(properties) of the members of the pool.
+      type: dict
+    wait_for:
+      description:
+        - Wait until the jail is ready after I(state=started) or I(state=restarted).
+          The checks are polled with exponential backoff until I(timeout). At least one of
+          I(port), I(cmd), and I(service) is required.
+      type: dict
+      suboptions:
+        port:
+          description:
+            - TCP port that accepts connections on I(host).
+          type: int
+        host:
+          description:
+            - Host of I(port). Defaults to the first address of the property I(ip4_addr) of the jail.
+          type: str
+        cmd:
+          description:
+            - Command that succeeds inside the jail.
+          type: str
+        service:
+          description:
+            - Service whose C(service <service> status) succeeds inside the jail.
+          type: str
+        timeout:
+          description:
+            - Maximal number of seconds to wait. The module fails when the jail isn't ready in time.
+          type: int
+          default: 60
+    rctl:
+      description:
+        - Collect also the I(rctl) counters by I(state=stats). C(rctl) is called once per running jail.
+      type: bool
+      default: False
+    facts_snapshot:
+      description:
+        - Path to a JSON file of recorded facts B(iocage_releases), B(iocage_templates), and
+          B(iocage_jails), e.g. the registered result of I(state=facts).
+        - If set the module doesn't run any command. It computes the B(plan) of the actions
+          for I(state) against the snapshot and returns it. Use it on the controller to plan
+          the changes of many hosts.
+        - Supported states are I(basejail), I(thickjail), I(template), I(present), I(cloned),
+          I(started), I(stopped), I(restarted), I(fetched), I(exists), I(absent), I(set), and
+          I(reconciled).
+          I(release) is required by the states I(basejail), I(thickjail), I(template), I(fetched),
+          and I(present), and by I(update=true), because the release of the host isn't in the facts.
+      type: path
+    lock_file:
+      description:
+        - Host-level lock file shared by all concurrent runs of the module.
+        - The states I(facts), I(exists), I(stats), I(exec), and I(pkg), and all states in
+          C(check_mode), take a shared lock and run concurrently. All other states take an
+          exclusive lock. I(state=started) and I(state=restarted) release the lock before
+          they poll I(wait_for).
+        - A waiting exclusive lock blocks new shared locks.
+      type: path
+      default: /var/run/ansible-iocage.lock
+    lock_timeout:
+      description:
+        - Number of seconds to wait for the lock I(lock_file). The module fails when
+          the lock can't be acquired in time.
+      type: int
+      default: 300
 requirements:
   - lang/python >= 3.6
   - sysutils/iocage
@@ -99,6 +246,49 @@ notes:
   - The module always creates facts B(iocage_releases), B(iocage_templates), and B(iocage_jails)
   - There is no mandatory option.
   - Returns B(module_args) when debugging is set B(ANSIBLE_DEBUG=true)
+  - I(state=exported) creates a new image only if there is no image of the jail in I(image_dir)
+    or I(update=true).
+  - I(state=stats) creates the fact B(iocage_stats) of the running jails, or of the jail I(name)
+    only. The number of processes, CPU (pcpu), and memory (rss and vsz in KiB) are collected by
+    one call of C(ps), and the ZFS usage by one call of C(zfs list). The I(rctl) counters are
+    collected only if I(rctl=true), by one call of C(rctl) per jail. They are empty if RACCT is
+    disabled (kern.racct.enable=0).
+  - I(state=updated) updates the jail I(name), or all jails and templates except basejails, to the
+    patch level of their fetched release. The patch levels of the releases are read by one batch
+    of C(freebsd-version -u) and only the jails of a lower patch level are updated.
+    Update the releases first by I(state=fetched) and I(update=true).
+  - The values of I(properties) are compared with the existing values, and passed to iocage,
+    in a canonical form by their type. For example C(true), C(yes), C(on), and C(1) of boolean
+    properties are equal, C(10G) and C(10240M) of I(quota) are equal, and the order of the
+    addresses in I(ip4_addr) and I(ip6_addr) doesn't matter. An address without interface
+    matches the same address on any interface.
+  - I(state=pooled) creates, or destroys, members of the pool I(pool) of the template I(clone_from)
+    until there are I(pool_size) of them. I(pool_properties) are set on the existing members,
+    and they are started or stopped by I(pool_started).
+  - I(state=allocated) renames the first member of the pool I(pool) to I(name), sets I(properties),
+    and starts the jail. The claim is atomic under the exclusive I(lock_file). The pool is refilled
+    in the background by a detached C(lockf(1)) process that waits for I(lock_file). Like the
+    exclusive lock it takes C(<lock_file>.w) first, so that the next run of the module waits for
+    the refill. The output of the refill is appended to C(<iocroot>/log/<pool>_refill.log). If the
+    pool is empty the jail is created from the template I(clone_from). I(properties) and
+    I(pool_properties) are validated before the member is claimed.
+  - I(state=reconciled) computes the minimal actions against one inventory of the host. Missing
+    releases are fetched first, then templates and jails are created or set in waves, so that
+    a jail or template is created after the one it is cloned from. The branches of a wave
+    (all actions of one jail) are executed in parallel. Pruning runs last. The returned B(plan)
+    is what was executed, or what would be executed in C(check_mode).
+  - I(state=set) and I(native=true) reads and writes C(config.json) once per jail instead of running
+    C(iocage get) and C(iocage set) per property. The jails that can't be written directly fall
+    back to C(iocage set), which restarts a running jail if a property needs it. The jails
+    written directly are not restarted. Booleans keep the form of the file (e.g. C(on)/C(off)).
+  - The runtime state (up/down, JID, and addresses) of the jails is read from C(jls --libxo=json).
+    C(iocage list) is used for the configuration data only.
+  - Waiting for an exclusive lock blocks new shared locks, i.e. mutating runs are not
+    starved by a stream of read-only runs.
+  - I(state=imported) records the SHA256 checksum of the image in the ZFS user property
+    C(ansible.iocage:image_sha256) of the jail's dataset. The import is skipped if the jail
+    exists and the checksums are identical. A jail imported from a different image is
+    destroyed and imported again only if I(update=true).
 seealso:
   - name: iocage - A FreeBSD Jail Manager
     description: iocage 1.2 documentation
@@ -180,16 +370,117 @@ EXAMPLES = r'''
     name: foo
     state: restarted
 
+- name: Start existing jail and wait for sshd
+  iocage:
+    name: foo
+    state: started
+    wait_for:
+      port: 22
+      service: sshd
+      timeout: 120
+
 - name: Execute command in running jail
   iocage:
     name: foo
     state: exec
     cmd: service sshd start
 
+- name: Upgrade packages in running jail. Keep the output in a file.
+  iocage:
+    name: foo
+    state: pkg
+    cmd: upgrade -y
+    output_file: /var/log/pkg-upgrade-foo.log
+  async: 3600
+  poll: 10
+
+- name: Keep 4 stopped pre-cloned jails of the template tplfoo
+  iocage:
+    state: pooled
+    clone_from: tplfoo
+    pool_size: 4
+    pool_properties:
+      boot: false
+
+- name: Allocate jail from the pool and refill the pool
+  iocage:
+    name: build42
+    state: allocated
+    clone_from: tplfoo
+    pool_size: 4
+    pool_properties:
+      boot: false
+    properties:
+      ip4_addr: 'lo1|10.1.0.42'
+
+- name: Plan the changes of jail foo against the recorded facts of host srv1
+  iocage:
+    name: foo
+    state: present
+    clone_from: tplfoo
+    release: 13.0-RELEASE
+    properties:
+      ip4_addr: 'lo1|10.1.0.5'
+    facts_snapshot: /var/cache/iocage/srv1.json
+  delegate_to: localhost
+
+- name: Converge the host
+  iocage:
+    state: reconciled
+    release: 13.0-RELEASE
+    prune: true
+    spec:
+      templates:
+        tplfoo:
+          properties:
+            defaultrouter: '10.1.0.1'
+      jails:
+        foo:
+          clone_from: tplfoo
+          state: started
+          properties:
+            ip4_addr: 'lo1|10.1.0.5'
+        bar:
+          clone_from: tplfoo
+          state: stopped
+
+- name: Set defaultrouter of many stopped jails in one pass
+  iocage:
+    names: "{{ iocage_jails.keys()|list }}"
+    state: set
+    native: true
+    properties:
+      defaultrouter: '10.1.0.254'
+
+- name: Update all jails to the patch level of their release, 8 jails in parallel
+  iocage:
+    state: updated
+    concurrency: 8
+
 - name: Destroy jail
   iocage:
     name: foo
     state: absent
+
+- name: Export stopped jail to image
+  iocage:
+    name: foo
+    state: exported
+    image_dir: /export/images
+
+- name: Import jail from image
+  iocage:
+    name: foo
+    state: imported
+    image: /export/images/foo_2021-08-31.zip
+
+- name: Collect resource usage of running jails
+  iocage:
+    state: stats
+
+- name: Display jails sorted by number of processes
+  debug:
+    msg: "{{ iocage_stats|dict2items|sort(attribute='value.processes', reverse=true)|map(attribute='key') }}"
 '''
 
 RETURN = r'''
@@ -210,28 +501,235 @@ ansible_facts:
       type: dict
       sample: {}
     iocage_jails:
-      description: Dictionary of all jails.
+      description: Dictionary of all jails. The runtime I(state), I(jid), I(ip4), and I(ip6)
+        are read from C(jls --libxo=json).
       returned: always
       type: dict
-      sample: {}
+      sample: {"foo": {"name": "foo", "state": "up", "jid": "3", "ip4": ["10.1.0.5"], "ip6": [],
+               "properties": {}}}
+image:
+  description: Path to the exported or imported image.
+  returned: I(state=exported) or I(state=imported)
+  type: str
+  sample: /iocage/images/foo_2021-08-31.zip
+checksum:
+  description: SHA256 checksum of the image.
+  returned: I(state=exported) or I(state=imported)
+  type: str
+native:
+  description: Properties written to config.json by I(native=true), by jail, and the jails
+    that fell back to C(iocage set).
+  returned: I(state=set) and I(native=true)
+  type: dict
+  sample: {"set": {"foo": {"defaultrouter": "10.1.0.254"}}, "fallback": ["bar"]}
+plan:
+  description: Actions planned against I(facts_snapshot), or executed by I(state=reconciled).
+    Each action lists the exact commands in order. I(restart) is true when a running jail is
+    stopped and started by the action. I(state=reconciled) adds the I(wave) and the I(status)
+    (C(done), C(failed), or C(skipped)) of the action, and the I(error) of a failed action.
+    The plan is returned also when the reconciliation fails.
+  returned: I(facts_snapshot) or I(state=reconciled)
+  type: list
+  elements: dict
+  sample: [{"action": "set", "name": "foo", "restart": true, "properties": {"ip4_addr": "lo1|10.1.0.6"},
+            "cmds": ["iocage stop foo", "iocage set ip4_addr=lo1|10.1.0.6 foo", "iocage start foo"]}]
+updates:
+  description: Jails updated by I(state=updated) with their old and new release. The jails
+    of a release whose patch level can't be read are I(skipped). On failure the jails that
+    were not updated have the error in I(failed).
+  returned: I(state=updated)
+  type: dict
+  sample: {"foo": {"old": "13.0-RELEASE-p3", "new": "13.0-RELEASE-p4"}}
+pool:
+  description: Members of the pool after I(state=pooled), or the claimed member and
+    the number of the members refilled in the background and the log of the refill after
+    I(state=allocated).
+  returned: I(state=pooled) or I(state=allocated)
+  type: dict
+  sample: {"member": "tplfoo_pool_3", "refill": 1, "log": "/iocage/log/tplfoo_pool_refill.log"}
+ready_time:
+  description: Number of seconds from starting the jail until the checks I(wait_for) passed.
+  returned: I(wait_for) with I(state=started) or I(state=restarted)
+  type: float
+  sample: 3.2
+lock_wait:
+  description: Number of seconds the module waited for the lock I(lock_file).
+  returned: always
+  type: float
+  sample: 0.0
 module_args:
   description: Information on how the module was invoked.
   returned: debug
   type: dict
 '''
 
+import fcntl
 import json
+import os
 import re
+import shlex
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils._text import to_bytes
+from ansible.module_utils._text import to_bytes, to_text
+
+
+# Types of the jail properties. Desired and existing values are
+# compared, and passed to iocage, in their canonical form. Properties
+# not listed here are compared as strings.
+PROPERTY_TYPES = dict(
+    allow_chflags="bool", allow_mlock="bool", allow_mount="bool", allow_mount_devfs="bool",
+    allow_mount_fusefs="bool", allow_mount_nullfs="bool", allow_mount_procfs="bool",
+    allow_mount_tmpfs="bool", allow_mount_zfs="bool", allow_quotas="bool", allow_raw_sockets="bool",
+    allow_set_hostname="bool", allow_socket_af="bool", allow_sysvipc="bool", allow_tun="bool",
+    allow_vmm="bool", assign_localhost="bool", basejail="bool", boot="bool", bpf="bool", dhcp="bool",
+    host_time="bool", ip_hostname="bool", jail_zfs="bool", mount_devfs="bool", mount_fdescfs="bool",
+    mount_linprocfs="bool", mount_procfs="bool", nat="bool", rtsold="bool", template="bool", vnet="bool",
+    children_max="int", devfs_ruleset="int", exec_timeout="int", priority="int", securelevel="int",
+    stop_timeout="int",
+    quota="size", reservation="size",
+    ip4_addr="iplist", ip6_addr="iplist",
+    ip4="enum", ip6="enum", sysvmsg="enum", sysvsem="enum", sysvshm="enum",
+)
+
+PROPERTY_CHOICES = dict(
+    ip4=["new", "inherit", "disable"],
+    ip6=["new", "inherit", "disable"],
+    sysvmsg=["new", "inherit", "disable"],
+    sysvsem=["new", "inherit", "disable"],
+    sysvshm=["new", "inherit", "disable"],
+)
+
+_SIZE_UNITS = dict(K=1, M=2, G=3, T=4, P=5)
+
+# Properties that iocage applies to ZFS or to the datasets by "iocage set",
+# and properties of a running jail that don't need to be applied at runtime.
+# See jails_set_native().
+NATIVE_UNSAFE = ["basejail", "compression", "dedup", "host_hostuuid", "jail_zfs", "jail_zfs_dataset",
+                 "quota", "release", "reservation", "template", "type"]
+NATIVE_RUNTIME_FREE = ["boot", "depends", "notes", "priority"]
+
+
+def _prop_canonical(prop, val):
+
+    if val is None:
+        return None
+    _type = PROPERTY_TYPES.get(prop, "str")
+    _val = str(val).strip()
+
+    if _type == "bool" or (_type == "str" and isinstance(val, bool)):
+        if _val.lower() in ["1", "yes", "on", "true"]:
+            return "1"
+        elif _val.lower() in ["0", "no", "off", "false"]:
+            return "0"
+        elif _type == "bool":
+            raise ValueError(f"{prop}={_val} is not a boolean")
+    if _val in ["", "-", "none"]:
+        return "none"
+
+    if _type == "int":
+        return str(int(_val))
+    elif _type == "size":
+        matches = re.match(r'(\d+(?:\.\d+)?)([KMGTP]?)B?$', _val, re.IGNORECASE)
+        if matches is None:
+            raise ValueError(f"{prop}={_val} is not a size")
+        return str(int(float(matches.group(1)) * 1024 ** _SIZE_UNITS.get(matches.group(2).upper(), 0)))
+    elif _type == "iplist":
+        # Keep the order. The first address is the primary one. See _prop_equal().
+        return ",".join(_ip.strip() for _ip in _val.split(","))
+    elif _type == "enum" and _val not in PROPERTY_CHOICES[prop]:
+        raise ValueError(f"{prop}={_val} is not one of {PROPERTY_CHOICES[prop]}")
+
+    return _val
+
+
+def _prop_equal(prop, val, oval):
+
+    try:
+        val = _prop_canonical(prop, val)
+        oval = _prop_canonical(prop, oval)
+    except ValueError:
+        return str(val) == str(oval)
+
+    if PROPERTY_TYPES.get(prop) == "iplist":
+        # An address without interface matches the address on any interface.
+        _ips = sorted((_ip.rpartition("|")[::2] for _ip in val.split(",")), key=lambda x: x[1])
+        _oips = sorted((_ip.rpartition("|")[::2] for _ip in oval.split(",")), key=lambda x: x[1])
+        return len(_ips) == len(_oips) and \
+            all(_a == _oa and _i in ["", _oi] for (_i, _a), (_oi, _oa) in zip(_ips, _oips))
+
+    return val == oval
 
 
 def _command_fail(module, label, cmd, rc, stdout, stderr):
     module.fail_json(msg=f"{label}\ncmd: '{cmd}' return: {rc}\nstdout: '{stdout}'\nstderr: '{stderr}'")
 
 
-def _get_iocage_facts(module, iocage_path, argument="all", name=None):
+def _flock(module, lock_file, fd, operation, deadline):
+
+    _delay = 0.1
+    while True:
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            _remaining = deadline - time.monotonic()
+            if _remaining <= 0:
+                _mode = "exclusive" if operation == fcntl.LOCK_EX else "shared"
+                module.fail_json(msg=f"Timeout waiting for {_mode} lock {lock_file}")
+            time.sleep(min(_delay, _remaining))
+            _delay = min(_delay * 2, 1)
+
+
+def _lock(module, lock_file, exclusive=True, timeout=300):
+
+    # Writers hold '<lock_file>.w' while they wait for and take lock_file.
+    # Readers pass '<lock_file>.w' before they take their shared lock_file.
+    _start = time.monotonic()
+    _deadline = _start + timeout
+    try:
+        _wfd = open(f"{lock_file}.w", 'a')
+        fd = open(lock_file, 'a')
+    except OSError as e:
+        module.fail_json(msg=f"Unable to open lock {lock_file}: {e}")
+
+    if exclusive:
+        _flock(module, lock_file, _wfd, fcntl.LOCK_EX, _deadline)
+        _flock(module, lock_file, fd, fcntl.LOCK_EX, _deadline)
+    else:
+        _flock(module, lock_file, _wfd, fcntl.LOCK_SH, _deadline)
+        _flock(module, lock_file, fd, fcntl.LOCK_SH, _deadline)
+    _wfd.close()
+
+    return fd, round(time.monotonic() - _start, 3)
+
+
+def _unlock(fd):
+
+    if fd is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        fd.close()
+
+
+def _jail_set_running(jails, running):
+
+    # The runtime state is taken from the kernel (jls), not from iocage list.
+    for _name, _jail in jails.items():
+        _jail["state"] = "up" if _name in running else "down"
+        _jail["jid"] = running[_name]["jid"] if _name in running else "-"
+        _jail["ip4"] = running[_name]["ip4"] if _name in running else []
+        _jail["ip6"] = running[_name]["ip6"] if _name in running else []
+
+    return jails
+
+
+def _get_iocage_facts(module, iocage_path, argument="all", name=None, running=True):
 
     opt = dict(jails="list -hl",
                templates="list -hlt",
@@ -240,9 +738,11 @@ def _get_iocage_facts(module, iocage_path, argument="all", name=None):
 
     if argument == "all":
         # _init = _get_iocage_facts(module, iocage_path, "init")
-        _jails = _get_iocage_facts(module, iocage_path, "jails")
-        _templates = _get_iocage_facts(module, iocage_path, "templates")
+        _jails = _get_iocage_facts(module, iocage_path, "jails", running=False)
+        _templates = _get_iocage_facts(module, iocage_path, "templates", running=False)
         _releases = _get_iocage_facts(module, iocage_path, "releases")
+        _jail_set_running(dict(_jails, **_templates),
+                          _get_jails_running(module, list(_jails) + list(_templates)))
         return dict(iocage_jails=_jails,
                     iocage_templates=_templates,
                     iocage_releases=_releases)
@@ -280,7 +780,7 @@ def _get_iocage_facts(module, iocage_path, argument="all", name=None):
                     (_jid, _name, _boot, _state, _type, _release, _ip4, _ip6, _template, _basejail) = _fragments
                 else:
                     (_jid, _name, _boot, _state, _type, _release, _ip4, _ip6, _template) = _fragments
-                if _name != "":
+                if _name != "" and (name is None or _name == name):
                     _properties = _jail_get_properties(module, iocage_path, _name)
                     _jails[_name] = {"jid": _jid, "name": _name, "state": _state, "properties": _properties}
             else:
@@ -288,6 +788,9 @@ def _get_iocage_facts(module, iocage_path, argument="all", name=None):
     except ValueError:
         module.fail_json(msg=f"unable to parse {state}")
 
+    if running:
+        _jail_set_running(_jails, _get_jails_running(module, list(_jails)))
+
     if name is not None:
         if name in _jails:
             return _jails[name]
@@ -297,29 +800,58 @@ def _get_iocage_facts(module, iocage_path, argument="all", name=None):
     return _jails
 
 
+def _parse_jls(out, names=None):
+
+    # Map the jails of 'jls -v --libxo=json' back to the iocage names by their path
+    # <iocroot>/{jails,templates}/<name>/root, or by ioc-<name>. iocage replaces '.'
+    # by '_' in ioc-<name>. The replacement is undone for the known names. Raise
+    # ValueError if out is unreadable.
+    try:
+        _jls = json.loads(out)["jail-information"]["jail"]
+    except (KeyError, TypeError) as e:
+        raise ValueError(e)
+    _names = dict((_name.replace('.', '_'), _name) for _name in names or [])
+
+    _running = {}
+    for _jail in _jls:
+        matches = re.search(r'/(?:jails|templates)/([^/]+)/root$', _jail.get("path", ""))
+        if matches is not None:
+            _name = matches.group(1)
+        elif _jail.get("name", "").startswith("ioc-"):
+            _name = _names.get(_jail["name"][4:], _jail["name"][4:])
+        else:
+            # non-iocage jails: skip
+            continue
+        _ip4 = _jail.get("ipv4_addrs", [_jail["ipv4"]] if _jail.get("ipv4") else [])
+        _ip6 = _jail.get("ipv6_addrs", [_jail["ipv6"]] if _jail.get("ipv6") else [])
+        _running[_name] = {"jid": str(_jail["jid"]), "ip4": _ip4, "ip6": _ip6}
+
+    return _running
+
+
+def _get_jails_running(module, names=None):
+
+    # Runtime state from the kernel. See _parse_jls().
+    jls_path = module.get_bin_path('jls', True)
+    cmd = f"{jls_path} -v --libxo=json"
+    rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                      errors='surrogate_or_strict')
+    if not rc == 0:
+        _command_fail(module, "_get_jails_running()", cmd, rc, out, err)
+    try:
+        return _parse_jls(out, names)
+    except ValueError:
+        module.fail_json(msg=f"_get_jails_running():\nUnreadable stdout from cmd '{cmd}': '{out}'")
+
+
 def _jail_started(module, iocage_path, name):
 
-    cmd = f"{iocage_path} list -h"
-    rc, state, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
-                                        errors='surrogate_or_strict')
-    if rc != 0:
-        _command_fail(module, f"jail_started({name})", cmd, rc, state, err)
-
-    st = None
-    for line in state.split('\n'):
-        u = line.split('\t')[1]
-        if u == name:
-            s = line.split('\t')[2]
-            if s == 'up':
-                st = True
-                break
-            elif s == 'down':
-                st = False
-                break
-            else:
-                module.fail_json(msg=f"Jail {name} unknown state: {line}")
+    return name in _get_jails_running(module, [name])
+
 
-    return st
+def _jail_update_state(module, jail, name):
+
+    return _jail_set_running({name: jail}, _get_jails_running(module, [name]))[name]
 
 
 def jail_exists(module, iocage_path, argument=None, assume_absent=False):
@@ -358,37 +890,82 @@ def jail_start(module, iocage_path, name):
     return _changed, _msg
 
 
+def _jail_ready(module, iocage_path, name, host, wait_for):
+
+    if wait_for["port"] is not None:
+        try:
+            socket.create_connection((host, wait_for["port"]), timeout=1).close()
+        except OSError:
+            return False
+    if wait_for["cmd"] is not None:
+        cmd = f"{iocage_path} exec {name} -- {wait_for['cmd']}"
+        rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                          errors='surrogate_or_strict')
+        if not rc == 0:
+            return False
+    if wait_for["service"] is not None:
+        cmd = f"{iocage_path} exec {name} -- service {wait_for['service']} status"
+        rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                          errors='surrogate_or_strict')
+        if not rc == 0:
+            return False
+
+    return True
+
+
+def jail_wait_for(module, iocage_path, name, properties, wait_for, start):
+
+    host = wait_for["host"]
+    if wait_for["port"] is not None and host is None:
+        _ip4 = properties.get("ip4_addr", "none").split(",")[0]
+        host = _ip4.rpartition("|")[2].split("/")[0]
+        if host in ["", "-", "none", "DHCP"]:
+            host = (_get_jails_running(module, [name]).get(name, {}).get("ip4") or [None])[0]
+        if host is None:
+            module.fail_json(msg=f"Jail {name} has no ip4_addr. Set host of wait_for.")
+
+    _deadline = start + wait_for["timeout"]
+    _delay = 0.5
+    while not _jail_ready(module, iocage_path, name, host, wait_for):
+        _remaining = _deadline - time.monotonic()
+        if _remaining <= 0:
+            module.fail_json(msg=f"Jail {name} not ready after {wait_for['timeout']}s: {wait_for}")
+        time.sleep(min(_delay, _remaining))
+        _delay = min(_delay * 2, 10)
+
+    ready_time = round(time.monotonic() - start, 3)
+    return ready_time, f"Jail {name} ready after {ready_time}s"
+
+
 def _props_to_str(props):
 
     argstr = ""
-    # local variable 'minargs' is assigned to but never used [F841]
-    # minargs = ""
     for _prop in props:
-        _val = props[_prop]
-        if _val == '-' or _val == '' or not _val:
+        _val = _prop_canonical(_prop, props[_prop])
+        if _val is None:
             continue
-        if _val in ['yes', 'on', True]:
-            argstr += f"{_prop}=1 "
-        elif _val in ['no', 'off', False]:
-            argstr += f"{_prop}=0 "
-        elif _val in ['-', 'none']:
-            argstr += f"{_prop}={_val} "
-        else:
-            argstr += f"{_prop}={str(_val)} "
+        argstr += f"{_prop}={shlex.quote(_val)} "
 
     return argstr
 
 
+def _release_fetch_cmd(iocage_path, update=False, release="NO-RELEASE", components=None, args=""):
+
+    args = "" if args is None else args
+    if update:
+        args += " -U"
+    if components is not None:
+        for _component in components:
+            if _component != "":
+                args += f" -F {_component}"
+
+    return f"{iocage_path} fetch -r {release} {args}"
+
+
 def release_fetch(module, iocage_path, update=False, release="NO-RELEASE", components=None, args=""):
 
     if not module.check_mode:
-        if update:
-            args += " -U"
-        if components is not None:
-            for _component in components:
-                if _component != "":
-                    args += f" -F {_component}"
-        cmd = f"{iocage_path} fetch -r {release} {args}"
+        cmd = _release_fetch_cmd(iocage_path, update, release, components, args)
         rc = 1
         rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
                                           errors='surrogate_or_strict')
@@ -445,7 +1022,41 @@ def jail_stop(module, iocage_path, name):
     return _changed, _msg
 
 
-def jail_exec(module, iocage_path, name, user="root", _cmd='/usr/bin/true'):
+def _file_tail(path, lines, block=65536, limit=1048576):
+
+    # Read the file backwards by blocks until it holds more than 'lines' lines
+    # (split also at '\r' of progress bars), but not more than 'limit' bytes.
+    data = b""
+    with open(path, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        while pos > 0 and len(data) < limit and len(data.splitlines()) <= lines:
+            _size = min(block, pos)
+            pos -= _size
+            f.seek(pos)
+            data = f.read(_size) + data
+
+    return b"".join(data.splitlines(keepends=True)[-lines:]) if lines > 0 else b""
+
+
+def _run_command_to_file(module, cmd, output_file, output_tail=20):
+
+    # run_command() with the environment of the module. The shell only redirects
+    # the output. The arguments are the same as without output_file.
+    try:
+        open(output_file, 'wb').close()
+    except OSError as e:
+        module.fail_json(msg=f"Unable to run '{cmd}' with output to {output_file}: {e}")
+    _cmd = " ".join(shlex.quote(_arg) for _arg in shlex.split(cmd))
+    rc, out, err = module.run_command(f"{_cmd} > {shlex.quote(output_file)} 2>&1", use_unsafe_shell=True)
+    try:
+        out = to_text(_file_tail(output_file, output_tail), errors='surrogate_or_replace')
+    except OSError as e:
+        module.fail_json(msg=f"Unable to read the output of '{cmd}' from {output_file}: {e}")
+
+    return rc, out
+
+
+def jail_exec(module, iocage_path, name, user="root", _cmd='/usr/bin/true', output_file=None, output_tail=20):
 
     rc = 1
     out = ""
@@ -454,20 +1065,26 @@ def jail_exec(module, iocage_path, name, user="root", _cmd='/usr/bin/true'):
     _changed = True
     if not module.check_mode:
         cmd = f"{iocage_path} exec -u {user} {name} -- {_cmd}"
-        rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
-                                          errors='surrogate_or_strict')
+        if output_file:
+            rc, out = _run_command_to_file(module, cmd, output_file, output_tail)
+        else:
+            rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                              errors='surrogate_or_strict')
         if not rc == 0:
             _command_fail(module,
                           f"Command '{_cmd}' could not be executed in jail '{name}'.",
                           cmd, rc, out, err)
-        _msg = (f"Command '{cmd}' was executed in jail '{name}'.\nrc: {rc}\nstdout:\n{out}\nstderr:\n{err}")
+        if output_file:
+            _msg = (f"Command '{cmd}' was executed in jail '{name}'.\nrc: {rc}\noutput: {output_file}")
+        else:
+            _msg = (f"Command '{cmd}' was executed in jail '{name}'.\nrc: {rc}\nstdout:\n{out}\nstderr:\n{err}")
     else:
         _msg = f"Command '{_cmd}' would have been executed in jail '{name}'."
 
     return _changed, _msg, out, err
 
 
-def jail_pkg(module, iocage_path, name, _cmd='info'):
+def jail_pkg(module, iocage_path, name, _cmd='info', output_file=None, output_tail=20):
 
     rc = 1
     out = ""
@@ -476,13 +1093,19 @@ def jail_pkg(module, iocage_path, name, _cmd='info'):
     _changed = True
     if not module.check_mode:
         cmd = f"{iocage_path} pkg {name} {_cmd}"
-        rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
-                                          errors='surrogate_or_strict')
+        if output_file:
+            rc, out = _run_command_to_file(module, cmd, output_file, output_tail)
+        else:
+            rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                              errors='surrogate_or_strict')
         if not rc == 0:
             _command_fail(module,
                           f"pkg '{_cmd}' could not be executed in jail '{name}'.",
                           cmd, rc, out, err)
-        _msg = (f"pkg '{_cmd}' was executed in jail '{name}'.\nstdout:\n{out}\nstderr:\n{err}")
+        if output_file:
+            _msg = (f"pkg '{_cmd}' was executed in jail '{name}'.\noutput: {output_file}")
+        else:
+            _msg = (f"pkg '{_cmd}' was executed in jail '{name}'.\nstdout:\n{out}\nstderr:\n{err}")
 
     else:
         _msg = f"pkg '{_cmd}' would have been executed in jail '{name}'."
@@ -516,6 +1139,30 @@ def _jail_get_properties(module, iocage_path, name):
     return properties
 
 
+def _props_diff(properties, existing_props):
+
+    _props_to_be_changed = {}
+    for _property in properties:
+        if _property not in existing_props:
+            continue
+        if existing_props[_property] == '-' and not properties[_property]:
+            continue
+        if _property == "template":
+            continue
+
+        propval = _prop_canonical(_property, properties[_property])
+        if propval is not None and \
+           ('CHECK_NEW_JAIL' in existing_props or not _prop_equal(_property, propval, existing_props[_property])):
+            _props_to_be_changed[_property] = propval
+
+    return _props_to_be_changed
+
+
+def _props_need_restart(props):
+
+    return any(p in ['ip4_addr', 'ip6_addr', 'template', 'interfaces', 'vnet', 'host_hostname'] for p in props)
+
+
 def jail_set(module, iocage_path, name, properties=None):
 
     if properties is None:
@@ -527,41 +1174,15 @@ def jail_set(module, iocage_path, name, properties=None):
     _changed = False
     cmd = ""
     _existing_props = _jail_get_properties(module, iocage_path, name)
-    _props_to_be_changed = {}
-    for _property in properties:
-        if _property not in _existing_props:
-            continue
-        if _existing_props[_property] == '-' and not properties[_property]:
-            continue
-        if _property == "template":
-            continue
-
-        propval = None
-        _val = properties[_property]
-        _oval = _existing_props[_property]
-        if _val in [0, 'no', 'off', False]:
-            propval = 0
-        elif _val in [1, 'yes', 'on', True]:
-            propval = 1
-        elif isinstance(_oval, str):
-            if _val == '':
-                propval = 'none'
-            else:
-                propval = f'{_val}'
-        else:
-            module.fail_json(msg="Unable to set attribute {0} to {1} for jail {2}"
-                             .format(_property, str(_val).replace("'", "'\\''"), name))
-
-        if 'CHECK_NEW_JAIL' in _existing_props or \
-           (_property in _existing_props.keys() and str(_existing_props[_property]) != str(propval)) and \
-           propval is not None:
-            _props_to_be_changed[_property] = propval
+    try:
+        _props_to_be_changed = _props_diff(properties, _existing_props)
+    except ValueError as e:
+        module.fail_json(msg=f"Unable to set attributes for jail {name}: {e}")
 
     if len(_props_to_be_changed) > 0:
         need_restart = False
-        for p in _props_to_be_changed.keys():
-            if p in ['ip4_addr', 'ip6_addr', 'template', 'interfaces', 'vnet', 'host_hostname']:
-                need_restart = _jail_started(module, iocage_path, name)
+        if _props_need_restart(_props_to_be_changed):
+            need_restart = _jail_started(module, iocage_path, name)
 
         cmd = f"{iocage_path} set {_props_to_str(_props_to_be_changed)} {name}"
 
@@ -586,33 +1207,47 @@ def jail_set(module, iocage_path, name, properties=None):
     return _changed, _msg
 
 
-def jail_create(module, iocage_path, name=None, properties=None, clone_from_name=None,
-                clone_from_template=None, release=None, basejail=False, thickjail=False, pkglist=None):
+def _jail_create_cmd(iocage_path, name=None, properties=None, clone_from_name=None,
+                     clone_from_template=None, release=None, basejail=False, thickjail=False, pkglist=None):
 
-    if properties is None:
-        properties = {}
-
-    rc = 1
-    out = ""
-    _msg = ""
+    _props = _props_to_str(properties or {})
 
     if clone_from_name is None and clone_from_template is None:
         if basejail:
             cmd = f"{iocage_path} create -b -n {name} -r {release}"
 
         elif thickjail:
-            cmd = f"{iocage_path} create -T -n {name} -r {release} {_props_to_str(properties)}"
+            cmd = f"{iocage_path} create -T -n {name} -r {release} {_props}"
 
         else:
-            cmd = f"{iocage_path} create -n {name} -r {release} {_props_to_str(properties)}"
+            cmd = f"{iocage_path} create -n {name} -r {release} {_props}"
 
         if pkglist:
             cmd += " --pkglist=" + pkglist
 
     elif clone_from_name:
-        cmd = f"{iocage_path} clone {clone_from_name} -n {name} {_props_to_str(properties)}"
+        cmd = f"{iocage_path} clone {clone_from_name} -n {name} {_props}"
     elif clone_from_template:
-        cmd = f"{iocage_path} create -t {clone_from_template} -n {name} {_props_to_str(properties)}"
+        cmd = f"{iocage_path} create -t {clone_from_template} -n {name} {_props}"
+
+    return cmd
+
+
+def jail_create(module, iocage_path, name=None, properties=None, clone_from_name=None,
+                clone_from_template=None, release=None, basejail=False, thickjail=False, pkglist=None):
+
+    if properties is None:
+        properties = {}
+
+    rc = 1
+    out = ""
+    _msg = ""
+
+    try:
+        cmd = _jail_create_cmd(iocage_path, name, properties, clone_from_name, clone_from_template,
+                               release, basejail, thickjail, pkglist)
+    except ValueError as e:
+        module.fail_json(msg=f"Unable to create jail {name}: {e}")
 
     if not module.check_mode:
         rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
@@ -631,23 +1266,65 @@ def jail_create(module, iocage_path, name=None, properties=None, clone_from_name
     return name, True, _msg
 
 
+def _patch_level(version):
+
+    matches = re.match(r'(.*?)(?:-p(\d+))?$', version.strip())
+    return matches.group(1), int(matches.group(2) or 0)
+
+
+def _get_release_versions(module, iocroot, releases):
+
+    _versions = {}
+    if not releases:
+        return _versions
+
+    # All releases in one shell. Each release's version is preceded by '# <release>'
+    # and followed by '!' if freebsd-version failed.
+    cmd = "; ".join(f"echo {shlex.quote('# ' + _release)}; "
+                    f"{shlex.quote(os.path.join(iocroot, 'releases', _release, 'root/bin/freebsd-version'))} -u"
+                    " || echo '!'"
+                    for _release in releases)
+    rc, out, err = module.run_command(cmd, use_unsafe_shell=True)
+    _release = None
+    _failed = set()
+    for line in out.split('\n'):
+        if line.startswith('# '):
+            _release = line[2:]
+        elif line.strip() == '!':
+            _failed.add(_release)
+        elif _release in releases and line.strip() != "":
+            _versions[_release] = line.strip()
+    for _release in _failed:
+        _versions.pop(_release, None)
+
+    return _versions
+
+
+def _jail_update(module, iocage_path, name):
+
+    cmd = f"{iocage_path} update {name}"
+    rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                      errors='surrogate_or_strict')
+    return cmd, rc, out, err
+
+
 def jail_update(module, iocage_path, name):
 
     rc = 1
     out = ""
     _msg = ""
     _changed = False
-    cmd = f"{iocage_path} update {name}"
     if not module.check_mode:
-        rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
-                                          errors='surrogate_or_strict')
+        cmd, rc, out, err = _jail_update(module, iocage_path, name)
         if not rc == 0:
             _command_fail(module, f"Jail '{name}' not updated.", cmd, rc, out, err)
         if "No updates needed" in out:
             _changed = False
+            _msg = f"jail {name} already updated"
         elif "updating to" in out:
-            nv = re.search(r' ([^ ]*):$', filter((lambda x: 'updating to' in x), out.split('\n'))[0]).group(1)
-            _msg = f"jail {name} updated to {nv}"
+            _line = next(filter((lambda x: 'updating to' in x), out.split('\n')))
+            nv = re.search(r' ([^ ]*):$', _line)
+            _msg = f"jail {name} updated to {nv.group(1) if nv else _line.strip()}"
             _changed = True
     else:
         _msg = "Unable to check for updates in check_mode"
@@ -655,6 +1332,71 @@ def jail_update(module, iocage_path, name):
     return _changed, _msg
 
 
+def jails_update(module, iocage_path, iocroot, jails, concurrency=4):
+
+    _changed = False
+    updates = {}
+
+    _releases = set()
+    for _jail in jails.values():
+        _releases.add(_patch_level(_jail["properties"].get("release", ""))[0])
+    _versions = _get_release_versions(module, iocroot, sorted(_releases))
+
+    _stale = {}
+    _skipped = []
+    for _name, _jail in jails.items():
+        if _jail["properties"].get("basejail") in ["1", "yes", "on", "true"]:
+            continue
+        _old = _jail["properties"].get("release", "")
+        _release, _patch = _patch_level(_old)
+        if _release not in _versions:
+            updates[_name] = {"old": _old, "new": None,
+                              "skipped": f"patch level of release {_release} unknown"}
+            _skipped.append(_name)
+        elif _patch < _patch_level(_versions[_release])[1]:
+            _stale[_name] = _old
+    _msgs = [f"jails {sorted(_skipped)} skipped"] if _skipped else []
+    if not _stale:
+        _current = sorted(set(jails.keys()) - set(_skipped))
+        if _current or not _skipped:
+            _msgs.insert(0, f"jails {_current} already updated")
+        return _changed, ", ".join(_msgs), updates
+
+    _changed = True
+    if module.check_mode:
+        for _name, _old in _stale.items():
+            updates[_name] = {"old": _old, "new": _versions[_patch_level(_old)[0]]}
+        _msgs.insert(0, f"jails {sorted(_stale.keys())} would have been updated")
+        return _changed, ", ".join(_msgs), updates
+
+    # Don't fail in the workers. Collect the results and fail afterwards.
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        _results = dict(zip(_stale.keys(),
+                            executor.map(lambda n: _jail_update(module, iocage_path, n), _stale.keys())))
+    _failed = {}
+    for _name, (cmd, rc, out, err) in _results.items():
+        if not rc == 0:
+            _failed[_name] = f"cmd: '{cmd}' return: {rc}\nstdout: '{out}'\nstderr: '{err}'"
+
+    for _name, _old in _stale.items():
+        cmd = f"{iocage_path} get release {_name}"
+        rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                          errors='surrogate_or_strict')
+        updates[_name] = {"old": _old, "new": out.strip() if rc == 0 else None}
+        if _name in _failed:
+            updates[_name]["failed"] = _failed[_name]
+        elif not rc == 0:
+            updates[_name]["failed"] = f"cmd: '{cmd}' return: {rc}\nstdout: '{out}'\nstderr: '{err}'"
+        else:
+            jails[_name]["properties"]["release"] = out.strip()
+    _failed = sorted(_name for _name in _stale if "failed" in updates[_name])
+    if _failed:
+        module.fail_json(msg=f"jails {_failed} not updated", updates=updates)
+    _msgs.insert(0, f"jails {sorted(_stale.keys())} were updated")
+
+    return _changed, ", ".join(_msgs), updates
+
+
 def jail_destroy(module, iocage_path, name):
 
     rc = 1
@@ -675,6 +1417,609 @@ def jail_destroy(module, iocage_path, name):
     return name, _changed, _msg
 
 
+def _get_iocroot(module, iocage_path):
+
+    cmd = f"{iocage_path} get -p"
+    rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                      errors='surrogate_or_strict')
+    if not rc == 0:
+        _command_fail(module, "_get_iocroot()", cmd, rc, out, err)
+    dataset = f"{out.strip()}/iocage"
+
+    zfs_path = module.get_bin_path('zfs', True)
+    cmd = f"{zfs_path} get -H -o value mountpoint {dataset}"
+    rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                      errors='surrogate_or_strict')
+    if not rc == 0:
+        _command_fail(module, "_get_iocroot()", cmd, rc, out, err)
+
+    return dataset, out.strip()
+
+
+def _is_image_of(image, name):
+
+    return re.match(rf'{re.escape(name)}_[\d-]+\.zip$', os.path.basename(image)) is not None
+
+
+def _image_list(image_dir, name):
+
+    _images = []
+    if os.path.isdir(image_dir):
+        for f in os.listdir(image_dir):
+            if _is_image_of(f, name):
+                _images.append(os.path.join(image_dir, f))
+
+    return sorted(_images, key=os.path.getmtime)
+
+
+def _copy_image(module, image, image_dir):
+
+    target = os.path.join(image_dir, os.path.basename(image))
+    try:
+        if not os.path.isdir(image_dir):
+            os.makedirs(image_dir)
+        if os.path.realpath(image) != os.path.realpath(target):
+            shutil.copy2(image, target)
+            _sha256 = re.sub(r'\.zip$', '.sha256', image)
+            if os.path.isfile(_sha256):
+                shutil.copy2(_sha256, image_dir)
+    except OSError as e:
+        module.fail_json(msg=f"Unable to copy image {image} to {image_dir}: {e}")
+
+    return target
+
+
+def _jail_image_checksum(module, dataset, name):
+
+    zfs_path = module.get_bin_path('zfs', True)
+    cmd = f"{zfs_path} get -H -o value ansible.iocage:image_sha256 {dataset}/jails/{name}"
+    rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                      errors='surrogate_or_strict')
+    if not rc == 0 or out.strip() == '-':
+        return None
+
+    return out.strip()
+
+
+def _get_iocage_stats(module, iocage_path, jails, dataset, rctl=False):
+
+    _stats = {}
+    for _name, _jail in jails.items():
+        if _jail["state"] == "up":
+            _stats[_name] = {"jid": _jail["jid"], "processes": 0, "rctl": {}, "used": None, "referenced": None}
+    if not _stats:
+        return _stats
+
+    # Processes, CPU, and memory of all jails from one call of ps.
+    ps_path = module.get_bin_path('ps', True)
+    cmd = f"{ps_path} -ax -o jid=,pcpu=,rss=,vsz="
+    rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                      errors='surrogate_or_strict')
+    if not rc == 0:
+        _command_fail(module, "_get_iocage_stats()", cmd, rc, out, err)
+    _usage = {}
+    for line in out.split('\n'):
+        _fragments = line.split()
+        if len(_fragments) != 4:
+            continue
+        _jid, _pcpu, _rss, _vsz = _fragments
+        _u = _usage.setdefault(_jid, {"processes": 0, "pcpu": 0.0, "rss": 0, "vsz": 0})
+        _u["processes"] += 1
+        _u["pcpu"] += float(_pcpu.replace(',', '.'))
+        _u["rss"] += int(_rss)
+        _u["vsz"] += int(_vsz)
+    for _name in _stats:
+        _u = _usage.get(_stats[_name]["jid"], {"processes": 0, "pcpu": 0.0, "rss": 0, "vsz": 0})
+        _u["pcpu"] = round(_u["pcpu"], 1)
+        _stats[_name].update(_u)
+
+    # rctl reports the usage of one jail per call. Opt-in by rctl=true.
+    rctl_path = module.get_bin_path('rctl') if rctl else None
+    if rctl_path is not None:
+        for _name in _stats:
+            cmd = f"{rctl_path} -u jail:ioc-{_name.replace('.', '_')}"
+            rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                              errors='surrogate_or_strict')
+            if not rc == 0:
+                # RACCT disabled (kern.racct.enable=0). There are no counters.
+                if "disabled" in err:
+                    break
+                _command_fail(module, "_get_iocage_stats()", cmd, rc, out, err)
+            for line in out.split('\n'):
+                if '=' in line:
+                    _key, _val = line.split('=', 1)
+                    _stats[_name]["rctl"][_key] = int(_val) if _val.isdigit() else _val
+
+    zfs_path = module.get_bin_path('zfs', True)
+    cmd = f"{zfs_path} list -H -p -d 1 -o name,used,referenced {dataset}/jails"
+    rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                      errors='surrogate_or_strict')
+    if not rc == 0:
+        _command_fail(module, "_get_iocage_stats()", cmd, rc, out, err)
+    for line in out.split('\n'):
+        _fragments = line.split('\t')
+        if len(_fragments) != 3:
+            continue
+        _name = _fragments[0].rsplit('/', 1)[-1]
+        if _name in _stats:
+            _stats[_name]["used"] = int(_fragments[1])
+            _stats[_name]["referenced"] = int(_fragments[2])
+
+    return _stats
+
+
+def jail_export(module, iocage_path, name, images, image_dir):
+
+    rc = 1
+    out = ""
+    _msg = ""
+    image = None
+    checksum = None
+    _changed = True
+    cmd = f"{iocage_path} export {name}"
+    if not module.check_mode:
+        rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                          errors='surrogate_or_strict')
+        if not rc == 0:
+            _command_fail(module, f"Jail '{name}' could not be exported.", cmd, rc, out, err)
+        _images = _image_list(images, name)
+        if not _images:
+            module.fail_json(msg=f"Jail '{name}' not exported ???\ncmd: {cmd}\nstdout:\n{out}\nstderr:\n{err}")
+        image = _images[-1]
+        image = _copy_image(module, image, image_dir)
+        checksum = module.sha256(image)
+        _msg = f"Jail '{name}' was exported to {image}."
+    else:
+        _msg = f"Jail '{name}' would have been exported to {image_dir}."
+
+    return image, checksum, _changed, _msg
+
+
+def jail_import(module, iocage_path, name, image, checksum, images, dataset):
+
+    rc = 1
+    out = ""
+    _msg = ""
+    _changed = True
+    _image = os.path.splitext(os.path.basename(image))[0]
+    cmd = f"{iocage_path} import {_image}"
+    if not module.check_mode:
+        _copy_image(module, image, images)
+        rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                          errors='surrogate_or_strict')
+        if not rc == 0:
+            _command_fail(module, f"Jail '{name}' could not be imported.", cmd, rc, out, err)
+        zfs_path = module.get_bin_path('zfs', True)
+        cmd = f"{zfs_path} set ansible.iocage:image_sha256={checksum} {dataset}/jails/{name}"
+        rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                          errors='surrogate_or_strict')
+        if not rc == 0:
+            _command_fail(module, f"Checksum of the image could not be recorded in jail '{name}'.", cmd, rc, out, err)
+        _msg = f"Jail '{name}' was imported from {image}."
+    else:
+        _msg = f"Jail '{name}' would have been imported from {image}."
+
+    return _changed, _msg
+
+
+def jail_rename(module, iocage_path, name, new_name):
+
+    rc = 1
+    out = ""
+    _msg = ""
+    _changed = True
+    cmd = f"{iocage_path} rename {name} {new_name}"
+    if not module.check_mode:
+        rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                          errors='surrogate_or_strict')
+        if not rc == 0:
+            _command_fail(module, f"Jail '{name}' could not be renamed to '{new_name}'.", cmd, rc, out, err)
+        _msg = f"Jail '{name}' was renamed to '{new_name}'."
+    else:
+        _msg = f"Jail '{name}' would have been renamed to '{new_name}'."
+
+    return new_name, _changed, _msg
+
+
+def _pool_members(jails, pool):
+
+    _members = [_name for _name in jails if re.match(rf'{re.escape(pool)}_\d+$', _name)]
+    return sorted(_members, key=lambda x: int(x.rsplit('_', 1)[1]))
+
+
+def _pool_new_members(pool, members, count):
+
+    _index = max([int(_member.rsplit('_', 1)[1]) for _member in members], default=0)
+    return [f"{pool}_{_index + i}" for i in range(1, count + 1)]
+
+
+def pool_refill(module, iocage_path, template, members, properties, started, lock_file, lock_timeout, log_file):
+
+    # Detach from the module. Like _lock() the refill takes '<lock_file>.w' before it waits for
+    # lock_file, and holds it until the pool is refilled. The output is appended to log_file.
+    cmds = ["set -ex"]
+    for _member in members:
+        cmds.append(f"{iocage_path} create -t {template} -n {_member} {_props_to_str(properties)}")
+        if started:
+            cmds.append(f"{iocage_path} start {_member}")
+    if len(cmds) == 1 or module.check_mode:
+        return
+    lockf_path = module.get_bin_path('lockf', True)
+    try:
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        with open(log_file, 'a') as f:
+            proc = subprocess.Popen([lockf_path, '-k', '-t', str(lock_timeout), f"{lock_file}.w",
+                                     lockf_path, '-k', '-t', str(lock_timeout), lock_file,
+                                     '/bin/sh', '-c', "; ".join(cmds)],
+                                    stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+        # Return when the refill holds '<lock_file>.w', so that the next run waits for it.
+        _deadline = time.monotonic() + 5
+        with open(f"{lock_file}.w", 'a') as _wfd:
+            while proc.poll() is None and time.monotonic() < _deadline:
+                try:
+                    fcntl.flock(_wfd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    break
+                fcntl.flock(_wfd, fcntl.LOCK_UN)
+                time.sleep(0.05)
+    except OSError as e:
+        module.fail_json(msg=f"Unable to refill pool: {e}")
+    if proc.poll() not in [None, 0]:
+        module.warn(f"Refill of the pool failed. See {log_file}")
+
+
+def _load_facts_snapshot(module, path):
+
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError) as e:
+        module.fail_json(msg=f"Unable to read facts_snapshot {path}: {e}")
+
+    snapshot = snapshot.get("ansible_facts", snapshot)
+    for _key in ["iocage_releases", "iocage_templates", "iocage_jails"]:
+        if _key not in snapshot:
+            module.fail_json(msg=f"facts_snapshot {path}: {_key} missing")
+
+    return snapshot
+
+
+def _plan_set(iocage_path, name, jail, properties, up=None):
+
+    # up is the state of the jail after the action. None keeps the current state.
+    _props = _props_diff(properties, jail["properties"])
+    if not _props:
+        return []
+    cmds = [f"{iocage_path} set {_props_to_str(_props)} {name}"]
+    restart = jail["state"] == "up" and _props_need_restart(_props)
+    if restart:
+        cmds = [f"{iocage_path} stop {name}"] + cmds
+        if up is False:
+            restart = False
+        else:
+            cmds.append(f"{iocage_path} start {name}")
+
+    return [dict(action="set", name=name, cmds=cmds, restart=restart, properties=_props)]
+
+
+def _jail_present_actions(state, name, properties, release, clone_from, update, facts):
+
+    # Decide the actions of the states present, cloned, template, basejail, and
+    # thickjail. Shared by run_module() and jail_plan(). Raise ValueError if
+    # clone_from doesn't exist.
+    actions = dict(fetch=release not in facts["iocage_releases"] and (state != "cloned" or update),
+                   create=name not in facts["iocage_templates"] and name not in facts["iocage_jails"],
+                   properties=dict(properties or {}), clone_from_name=None, clone_from_template=None,
+                   basejail=state == "basejail", thickjail=state == "thickjail", update=update)
+
+    if state == "template":
+        actions["properties"]["template"] = "true"
+        actions["properties"]["boot"] = "false"
+    elif state == "basejail":
+        actions["properties"] = {}
+    elif state != "thickjail" and clone_from:
+        if clone_from in facts["iocage_jails"]:
+            actions["clone_from_name"] = clone_from
+        elif clone_from in facts["iocage_templates"]:
+            actions["clone_from_template"] = clone_from
+        else:
+            raise ValueError(f"unable to create jail {name}\nbasejail {clone_from} doesn't exist")
+
+    return actions
+
+
+def jail_plan(iocage_path, params, facts):
+
+    # Decide the actions of the state against the facts only. Raise ValueError
+    # on invalid input.
+    state = params["state"]
+    name = params["name"]
+    release = params["release"]
+    properties = dict(params["properties"] or {})
+    clone_from = params["clone_from"]
+    jails = dict(facts["iocage_jails"], **facts["iocage_templates"])
+    plan = []
+
+    if state == "reconciled":
+        return reconcile_plan(iocage_path, params["spec"] or {}, facts, release, params["prune"])
+    if state not in ["basejail", "thickjail", "template", "present", "cloned", "started", "stopped",
+                     "restarted", "fetched", "exists", "absent", "set"]:
+        raise ValueError(f"state {state} not supported with facts_snapshot")
+    if name is None and state not in ["fetched"]:
+        raise ValueError(f"name needed for state {state}")
+    if state in ["started", "stopped", "restarted", "set", "exists"] and name not in jails:
+        raise ValueError(f"Jail '{name}' doesn't exist")
+    # run_module() takes the release of the host. It isn't in the facts.
+    if (state in ["basejail", "thickjail", "template", "fetched", "present"] or params["update"]) and not release:
+        raise ValueError(f"release needed for state {state} with facts_snapshot")
+
+    if state == "started":
+        if jails[name]["state"] != "up":
+            plan.append(dict(action="start", name=name, cmds=[f"{iocage_path} start {name}"], restart=False))
+
+    elif state == "stopped":
+        if jails[name]["state"] == "up":
+            plan.append(dict(action="stop", name=name, cmds=[f"{iocage_path} stop {name}"], restart=False))
+
+    elif state == "restarted":
+        plan.append(dict(action="restart", name=name, cmds=[f"{iocage_path} restart {name}"], restart=True))
+
+    elif state == "fetched":
+        if params["update"] or release not in facts["iocage_releases"]:
+            cmd = _release_fetch_cmd(iocage_path, params["update"], release, params["components"], params["args"])
+            plan.append(dict(action="fetch", name=release, cmds=[cmd], restart=False))
+
+    elif state == "set":
+        plan += _plan_set(iocage_path, name, jails[name], properties)
+
+    elif state in ["present", "cloned", "template", "basejail", "thickjail"]:
+        actions = _jail_present_actions(state, name, properties, release, clone_from, params["update"], facts)
+        if actions["fetch"]:
+            cmd = _release_fetch_cmd(iocage_path, params["update"], release, params["components"], params["args"])
+            plan.append(dict(action="fetch", name=release, cmds=[cmd], restart=False))
+        if actions["create"]:
+            cmd = _jail_create_cmd(iocage_path, name, actions["properties"], actions["clone_from_name"],
+                                   actions["clone_from_template"], release, actions["basejail"],
+                                   actions["thickjail"], params["pkglist"])
+            plan.append(dict(action="create", name=name, cmds=[cmd], restart=False))
+        else:
+            plan += _plan_set(iocage_path, name, jails[name], actions["properties"])
+        if actions["update"]:
+            plan.append(dict(action="update", name=name, cmds=[f"{iocage_path} update {name}"], restart=False))
+
+    elif state == "absent":
+        if name in jails:
+            cmds = [f"{iocage_path} destroy -f {name}"]
+            if jails[name]["state"] == "up":
+                cmds.insert(0, f"{iocage_path} stop {name}")
+            plan.append(dict(action="destroy", name=name, cmds=cmds, restart=False))
+
+    return plan
+
+
+def reconcile_plan(iocage_path, spec, facts, release=None, prune=False):
+
+    # Decide the actions of the whole host against the facts only. Raise
+    # ValueError on invalid spec.
+    jails = dict(facts["iocage_jails"], **facts["iocage_templates"])
+    items = {}
+    for _name, _spec in (spec.get("templates") or {}).items():
+        _spec = dict(_spec or {})
+        _spec["properties"] = dict(_spec.get("properties") or {}, template="true", boot="false")
+        items[_name] = _spec
+    for _name, _spec in (spec.get("jails") or {}).items():
+        if _name in items:
+            raise ValueError(f"{_name} is both a template and a jail in spec")
+        items[_name] = dict(_spec or {})
+    plan = []
+
+    # wave 0: releases
+    _releases = set(spec.get("releases") or [])
+    for _name, _spec in items.items():
+        if _name not in jails and not _spec.get("clone_from"):
+            _release = _spec.get("release") or release
+            if not _release:
+                raise ValueError(f"release needed for {_name}")
+            _releases.add(_release)
+    for _release in sorted(_releases - set(facts["iocage_releases"])):
+        plan.append(dict(action="fetch", name=_release, wave=0, restart=False,
+                         cmds=[_release_fetch_cmd(iocage_path, release=_release)]))
+
+    # wave n: templates and jails after the ones they are cloned from
+    def _wave(name, seen=()):
+        _clone_from = items[name].get("clone_from")
+        if _clone_from not in items:
+            return 1
+        if _clone_from in seen:
+            raise ValueError(f"clone_from loop in spec: {' -> '.join(seen + (name, _clone_from))}")
+        return _wave(_clone_from, seen + (name,)) + 1
+
+    _last = 1
+    for _name, _spec in items.items():
+        _w = 1 if _name in jails else _wave(_name)
+        _last = max(_last, _w)
+        _state = _spec.get("state")
+        if _state not in [None, "started", "stopped"]:
+            raise ValueError(f"state {_state} of {_name} not understood")
+        if _state == "started" and _name in (spec.get("templates") or {}):
+            raise ValueError(f"template {_name} can't be started")
+        if _name in jails:
+            _set = _plan_set(iocage_path, _name, jails[_name], _spec.get("properties") or {},
+                             {"started": True, "stopped": False}.get(_state))
+            plan += [dict(_action, wave=_w) for _action in _set]
+            # The set of a running jail to be stopped doesn't start it again.
+            _up = jails[_name]["state"] == "up"
+            if _set and _set[0]["cmds"][0] == f"{iocage_path} stop {_name}":
+                _up = _set[0]["restart"]
+        else:
+            _clone_from = _spec.get("clone_from")
+            clone_from_name = None
+            clone_from_template = None
+            if _clone_from in facts["iocage_jails"] or _clone_from in (spec.get("jails") or {}):
+                clone_from_name = _clone_from
+            elif _clone_from in facts["iocage_templates"] or _clone_from in (spec.get("templates") or {}):
+                clone_from_template = _clone_from
+            elif _clone_from:
+                raise ValueError(f"unable to create jail {_name}\nbasejail {_clone_from} doesn't exist")
+            cmd = _jail_create_cmd(iocage_path, _name, _spec.get("properties") or {}, clone_from_name,
+                                   clone_from_template, _spec.get("release") or release, pkglist=_spec.get("pkglist"))
+            plan.append(dict(action="create", name=_name, wave=_w, cmds=[cmd], restart=False))
+            _up = False
+        if _state == "started" and not _up:
+            plan.append(dict(action="start", name=_name, wave=_w, cmds=[f"{iocage_path} start {_name}"], restart=False))
+        elif _state == "stopped" and _up:
+            plan.append(dict(action="stop", name=_name, wave=_w, cmds=[f"{iocage_path} stop {_name}"], restart=False))
+
+    # last wave: prune
+    if prune and not spec.get("jails"):
+        raise ValueError("prune needs jails in spec. It would destroy all jails.")
+    if prune:
+        for _name, _jail in facts["iocage_jails"].items():
+            if _name in items:
+                continue
+            cmds = [f"{iocage_path} destroy -f {_name}"]
+            if _jail["state"] == "up":
+                cmds.insert(0, f"{iocage_path} stop {_name}")
+            plan.append(dict(action="destroy", name=_name, wave=_last + 1, cmds=cmds, restart=False))
+
+    return plan
+
+
+def reconcile_execute(module, plan, concurrency=4):
+
+    # Mark the outcome of each action: done, failed (with error), or skipped.
+    def _run(actions):
+        for _action in actions:
+            for cmd in _action["cmds"]:
+                rc, out, err = module.run_command(to_bytes(cmd, errors='surrogate_or_strict'),
+                                                  errors='surrogate_or_strict')
+                if not rc == 0:
+                    _action["status"] = "failed"
+                    _action["error"] = dict(cmd=cmd, rc=rc, stdout=out, stderr=err)
+                    return _action["name"]
+            _action["status"] = "done"
+        return None
+
+    # The actions of one name are a branch. Branches of a wave run in parallel.
+    # Don't fail in the workers. Collect the results and fail afterwards.
+    for _wave in sorted(set(_action["wave"] for _action in plan)):
+        branches = {}
+        for _action in plan:
+            if _action["wave"] == _wave:
+                branches.setdefault(_action["name"], []).append(_action)
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+            _failed = [_f for _f in executor.map(_run, branches.values()) if _f is not None]
+        if _failed:
+            for _action in plan:
+                _action.setdefault("status", "skipped")
+            module.fail_json(msg=f"Reconciliation failed in wave {_wave} for {_failed}.", plan=plan)
+
+
+def _jail_config_path(iocroot, name):
+
+    for _dir in ["jails", "templates"]:
+        _path = os.path.join(iocroot, _dir, name, "config.json")
+        if os.path.isfile(_path):
+            return _path
+
+    return None
+
+
+def _write_json_atomic(module, path, data):
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".config.json.")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=4, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError as e:
+        os.unlink(tmp)
+        module.fail_json(msg=f"Unable to write {path}: {e}")
+    module.atomic_move(tmp, path)
+
+
+def _native_value(prop, val, oval, boolean=False):
+
+    # Keep the JSON type of the existing value, and the vocabulary (on/off,
+    # yes/no, ...) of a boolean stored as string. Raise ValueError if unknown.
+    if isinstance(oval, bool):
+        return val == "1"
+    elif isinstance(oval, int) and re.match(r'-?\d+$', val):
+        return int(val)
+    elif isinstance(oval, str) and (boolean or PROPERTY_TYPES.get(prop) == "bool"):
+        for _true, _false in [("1", "0"), ("on", "off"), ("yes", "no"), ("true", "false")]:
+            if oval.lower() in [_true, _false]:
+                _new = _true if val == "1" else _false
+                return _new.upper() if oval.isupper() else _new
+        raise ValueError(f"{prop}={oval} is not a boolean")
+
+    return val
+
+
+def jails_set_native(module, iocroot, names, properties, running):
+
+    _msg = ""
+    _changed = False
+    updates = {}
+    fallback = []
+
+    try:
+        _props = dict((_k, _prop_canonical(_k, _v)) for _k, _v in properties.items()
+                      if _v is not None and _k != "template")
+    except ValueError as e:
+        module.fail_json(msg=f"Unable to set attributes: {e}")
+
+    for _name in names:
+        _config_path = _jail_config_path(iocroot, _name)
+        try:
+            with open(_config_path) as f:
+                _config = json.load(f)
+        except (TypeError, OSError, ValueError):
+            fallback.append(_name)
+            continue
+
+        if any(_k not in _config or _k in NATIVE_UNSAFE for _k in _props):
+            fallback.append(_name)
+            continue
+        _diff = {}
+        for _k, _v in _props.items():
+            _old = _config[_k]
+            # A boolean given for a property unknown to PROPERTY_TYPES, stored as string.
+            if isinstance(properties[_k], bool) and isinstance(_old, str) and \
+               _old.lower() in ["1", "yes", "on", "true", "0", "no", "off", "false"]:
+                _old = _old.lower() in ["1", "yes", "on", "true"]
+            if not _prop_equal(_k, _v, _old):
+                _diff[_k] = _v
+        if _name in running and any(_k not in NATIVE_RUNTIME_FREE for _k in _diff):
+            fallback.append(_name)
+            continue
+        if not _diff:
+            continue
+
+        try:
+            _config.update((_k, _native_value(_k, _v, _config[_k], isinstance(properties[_k], bool)))
+                           for _k, _v in _diff.items())
+        except ValueError:
+            fallback.append(_name)
+            continue
+        if not module.check_mode:
+            _write_json_atomic(module, _config_path, _config)
+        updates[_name] = _diff
+
+    if updates:
+        _changed = True
+        if module.check_mode:
+            _msg = f"properties would have been written to config.json of jails {sorted(updates.keys())}"
+        else:
+            _msg = f"properties were written to config.json of jails {sorted(updates.keys())}"
+    else:
+        _msg = f"properties {list(properties.keys())} already set in config.json of jails {names}"
+
+    return _changed, _msg, dict(set=updates, fallback=fallback)
+
+
 def run_module():
 
     module_args = dict(
@@ -682,8 +2027,11 @@ def run_module():
                    default="facts",
                    choices=["basejail", "thickjail", "template", "present", "cloned", "started",
                             "stopped", "restarted", "fetched", "exec", "pkg", "exists", "absent",
-                            "set", "facts"],),
+                            "set", "facts", "exported", "imported", "stats", "updated", "pooled",
+                            "allocated", "reconciled"],),
         name=dict(type='str'),
+        names=dict(type='list', elements='str'),
+        native=dict(type='bool', default=False),
         pkglist=dict(type='path'),
         properties=dict(type='dict'),
         args=dict(type='dict'),
@@ -692,16 +2040,54 @@ def run_module():
         clone_from=dict(type='str'),
         release=dict(type='str'),
         update=dict(type='bool', default=False,),
-        components=dict(type='list', elements='path', aliases=["files", "component"],),)
+        concurrency=dict(type='int', default=4),
+        spec=dict(type='dict'),
+        prune=dict(type='bool', default=False),
+        pool=dict(type='str'),
+        pool_size=dict(type='int', default=1),
+        pool_started=dict(type='bool', default=False),
+        pool_properties=dict(type='dict'),
+        components=dict(type='list', elements='path', aliases=["files", "component"],),
+        image=dict(type='path'),
+        image_dir=dict(type='path'),
+        wait_for=dict(type='dict',
+                      options=dict(port=dict(type='int'),
+                                   host=dict(type='str'),
+                                   cmd=dict(type='str'),
+                                   service=dict(type='str'),
+                                   timeout=dict(type='int', default=60),),
+                      required_one_of=[["port", "cmd", "service"]],),
+        rctl=dict(type='bool', default=False),
+        facts_snapshot=dict(type='path'),
+        output_file=dict(type='path'),
+        output_tail=dict(type='int', default=20),
+        lock_file=dict(type='path', default="/var/run/ansible-iocage.lock"),
+        lock_timeout=dict(type='int', default=300),)
 
     module = AnsibleModule(argument_spec=module_args,
+                           mutually_exclusive=[["name", "names"]],
+                           required_if=[["state", "reconciled", ["spec"]]],
                            supports_check_mode=True)
 
-    iocage_path = module.get_bin_path('iocage', True)
+    p = module.params
+
+    iocage_path = module.get_bin_path('iocage', not p["facts_snapshot"])
+    if not iocage_path and p["facts_snapshot"]:
+        iocage_path = "iocage"
     if not iocage_path:
         module.fail_json(msg='Utility iocage not found!')
 
-    p = module.params
+    if p["facts_snapshot"]:
+        facts = _load_facts_snapshot(module, p["facts_snapshot"])
+        try:
+            plan = jail_plan(iocage_path, p, facts)
+        except ValueError as e:
+            module.fail_json(msg=str(e))
+        _msg = ", ".join(f"{_action['action']} {_action['name']}" for _action in plan)
+        module.exit_json(changed=len(plan) > 0,
+                         msg=f"planned: {_msg}" if plan else "nothing to do",
+                         plan=plan)
+
     name = p["name"]
     properties = p["properties"]
     cmd = p["cmd"]
@@ -712,11 +2098,19 @@ def run_module():
     update = p["update"]
     components = p["components"]
     pkglist = p["pkglist"]
+    image = p["image"]
+    image_dir = p["image_dir"]
 
     msgs = []
     changed = False
     out = ""
     err = ""
+    extra = {}
+
+    # The lock is released when the module exits, or before the wait_for poll.
+    # exec and pkg don't change the configuration of iocage.
+    exclusive = p["state"] not in ["facts", "exists", "stats", "exec", "pkg"] and not module.check_mode
+    _lock_fd, extra["lock_wait"] = _lock(module, p["lock_file"], exclusive, p["lock_timeout"])
 
     facts = _get_iocage_facts(module, iocage_path, "all")
 
@@ -733,6 +2127,7 @@ def run_module():
                       stdout=out,
                       stderr=err,
                       )
+        result.update(extra)
         if module._debug:
             result['module_args'] = f"{(json.dumps(module.params, indent=4))}"
         module.exit_json(**result)
@@ -740,11 +2135,32 @@ def run_module():
     # Input validation
 
     # states that need name of jail
-    if name is None and p["state"] in ["started", "stopped", "restarted", "exists", "set", "exec", "pkg", "absent"]:
-        module.fail_json(msg=f"name needed for state {p['state']}")
+    if name is None and p["state"] in ["started", "stopped", "restarted", "exists", "set", "exec", "pkg", "absent",
+                                       "exported", "imported", "allocated"]:
+        if p["state"] != "set" or not p["names"]:
+            module.fail_json(msg=f"name needed for state {p['state']}")
+
+    if p["output_tail"] < 0:
+        module.fail_json(msg=f"output_tail must not be negative: {p['output_tail']}")
+
+    if p["names"] and p["state"] != "set":
+        module.fail_json(msg="names is supported only by state set")
+
+    # states that need template
+    if p["state"] in ["pooled", "allocated"]:
+        if clone_from not in facts["iocage_templates"]:
+            module.fail_json(msg=f"Template '{clone_from}' doesn't exist")
+        pool = p["pool"] or f"{clone_from}_pool"
+        pool_properties = p["pool_properties"] or {}
+        # Fail before a member is claimed.
+        try:
+            _props_to_str(pool_properties)
+            _props_to_str(properties or {})
+        except ValueError as e:
+            module.fail_json(msg=f"Unable to set attributes of pool {pool}: {e}")
 
     # states that need release defined
-    if p["state"] in ["basejail", "thickjail", "template", "fetched", "present"] or p["update"]:
+    if p["state"] in ["basejail", "thickjail", "template", "fetched", "present", "reconciled"] or p["update"]:
         if release is None or release == "":
             # if name and not (upgrade):
             #     _jail_props = _jail_get_properties(module, iocage_path, name)
@@ -761,48 +2177,70 @@ def run_module():
                 module.fail_json(msg=f"Release not recognised: {out}")
 
     # need existing jail
-    if p["state"] in ["started", "stopped", "restarted", "set", "exec", "pkg", "exists"]:
-        if name not in jails:
-            module.fail_json(msg=f"Jail '{name}' doesn't exist")
+    if p["state"] in ["started", "stopped", "restarted", "set", "exec", "pkg", "exists", "exported"] or \
+       (p["state"] in ["stats", "updated"] and name is not None):
+        for _name in p["names"] or [name]:
+            if _name not in jails:
+                module.fail_json(msg=f"Jail '{_name}' doesn't exist")
 
     # states that need running jail
     if p["state"] in ["exec", "pkg"] and jails[name]["state"] != "up":
         module.fail_json(msg=f"Jail '{name}' not running")
 
+    # states that need stopped jail
+    if p["state"] in ["exported"] and jails[name]["state"] == "up":
+        module.fail_json(msg=f"Jail '{name}' must be stopped")
+
     if p["state"] == "started":
+        _start = time.monotonic()
         if jails[name]["state"] != "up":
             changed, _msg = jail_start(module, iocage_path, name)
             msgs.append(_msg)
-            jails[name] = _get_iocage_facts(module, iocage_path, "jails", name)
+            _jail_update_state(module, jails[name], name)
             if jails[name]["state"] != "up" and not module.check_mode:
                 module.fail_json(msg=f"Starting jail {name} failed with {_msg}")
         else:
             msgs.append(f"Jail {name} already started")
+        if p["wait_for"] and not module.check_mode:
+            _unlock(_lock_fd)
+            _lock_fd = None
+            extra["ready_time"], _msg = jail_wait_for(module, iocage_path, name, jails[name]["properties"],
+                                                      p["wait_for"], _start)
+            msgs.append(_msg)
 
     elif p["state"] == "stopped":
         if jails[name]["state"] == "up":
             changed, _msg = jail_stop(module, iocage_path, name)
             msgs.append(_msg)
             if not module.check_mode:
-                jails[name] = _get_iocage_facts(module, iocage_path, "jails", name)
+                _jail_update_state(module, jails[name], name)
                 if jails[name]["state"] != "down":
                     module.fail_json(msg=f"Stopping jail {name} failed with {_msg}")
         else:
             msgs.append(f"Jail {name} already stopped")
 
     elif p["state"] == "restarted":
+        _start = time.monotonic()
         changed, _msg = jail_restart(module, iocage_path, name)
-        jails[name] = _get_iocage_facts(module, iocage_path, "jails", name)
-        if jails[name]["state"] != "up":
+        _jail_update_state(module, jails[name], name)
+        if jails[name]["state"] != "up" and not module.check_mode:
             module.fail_json(msg=f"Restarting jail {name} failed with {_msg}")
         msgs.append(_msg)
+        if p["wait_for"] and not module.check_mode:
+            _unlock(_lock_fd)
+            _lock_fd = None
+            extra["ready_time"], _msg = jail_wait_for(module, iocage_path, name, jails[name]["properties"],
+                                                      p["wait_for"], _start)
+            msgs.append(_msg)
 
     elif p["state"] == "exec":
-        changed, _msg, out, err = jail_exec(module, iocage_path, name, user, cmd)
+        changed, _msg, out, err = jail_exec(module, iocage_path, name, user, cmd,
+                                            p["output_file"], p["output_tail"])
         msgs.append(_msg)
 
     elif p["state"] == "pkg":
-        changed, _msg, out, err = jail_pkg(module, iocage_path, name, cmd)
+        changed, _msg, out, err = jail_pkg(module, iocage_path, name, cmd,
+                                           p["output_file"], p["output_tail"])
         msgs.append(_msg)
 
     elif p["state"] == "exists":
@@ -819,73 +2257,51 @@ def run_module():
             msgs.append(f"Release {release} already fetched")
 
     elif p["state"] == "set":
-        changed, _msg = jail_set(module, iocage_path, name, properties)
-        msgs.append(_msg)
-        jails[name] = _get_iocage_facts(module, iocage_path, "jails", name)
+        names = p["names"] or [name]
+        if p["native"]:
+            iocroot_dataset, iocroot = _get_iocroot(module, iocage_path)
+            changed, _msg, extra["native"] = jails_set_native(module, iocroot, names, properties or {},
+                                                              _get_jails_running(module, names))
+            msgs.append(_msg)
+            for _name, _props in extra["native"]["set"].items():
+                jails[_name]["properties"].update(_props)
+            names = extra["native"]["fallback"]
+        for _name in names:
+            _changed, _msg = jail_set(module, iocage_path, _name, properties)
+            changed = changed or _changed
+            msgs.append(_msg)
+            jails[_name] = _get_iocage_facts(module, iocage_path, "jails", _name)
 
     elif p["state"] in ["present", "cloned", "template", "basejail", "thickjail"]:
 
-        do_basejail = False
-        do_thickjail = False
-        clone_from_name = None
-        clone_from_template = None
-        # local variable 'jail_exists' is assigned to but never used [F841]
-        # jail_exists = False
+        try:
+            actions = _jail_present_actions(p["state"], name, properties, release, clone_from, update, facts)
+        except ValueError as e:
+            if not module.check_mode:
+                module.fail_json(msg=str(e))
+            # todo: use facts to check if basejail would have been created before
+            msgs.append(f"Jail {name} would have been cloned from (nonexisting) jail or template {clone_from}")
+            actions = _jail_present_actions(p["state"], name, properties, release, None, update, facts)
 
-        if p["state"] != "cloned" and release not in facts["iocage_releases"]:
+        if actions["fetch"]:
             release, _release_changed, _release_msg = release_fetch(module, iocage_path, update, release, components, args)
             if _release_changed:
                 facts["iocage_releases"] = _get_iocage_facts(module, iocage_path, "releases")
                 msgs.append(_release_msg)
 
-        if p["state"] == "template":
-            if properties is None:
-                properties = {}
-            properties["template"] = "true"
-            properties["boot"] = "false"
-            if name in facts["iocage_templates"]:
-                # local variable 'jail_exists' is assigned to but never used [F841]
-                # jail_exists = True
-                pass
-
-        elif p["state"] == "basejail":
-            properties = {}
-            do_basejail = True
-
-        elif p["state"] == "thickjail":
-            do_thickjail = True
-
-        elif clone_from:
-            if clone_from in facts["iocage_jails"]:
-                clone_from_name = clone_from
-            elif clone_from in facts["iocage_templates"]:
-                clone_from_template = clone_from
-            else:
-                if module.check_mode:
-                    # todo: use facts to check if basejail would have been created before
-                    msgs.append(f"Jail {name} would have been cloned from (nonexisting) jail or template {clone_from}")
-                else:
-                    module.fail_json(msg=f"unable to create jail {name}\nbasejail {clone_from} doesn't exist")
-
-        if name not in facts["iocage_templates"] and name not in facts["iocage_jails"]:
-            name, changed, _msg = jail_create(module, iocage_path, name, properties, clone_from_name,
-                                              clone_from_template, release, do_basejail, do_thickjail,
-                                              pkglist)
+        if actions["create"]:
+            name, changed, _msg = jail_create(module, iocage_path, name, actions["properties"],
+                                              actions["clone_from_name"], actions["clone_from_template"],
+                                              release, actions["basejail"], actions["thickjail"], pkglist)
             msgs.append(_msg)
         else:
-            changed, _msg = jail_set(module, iocage_path, name, properties)
+            changed, _msg = jail_set(module, iocage_path, name, actions["properties"])
             msgs.append("%s already exists" % (name))
             if changed:
                 msgs.append(_msg)
 
-        if p["update"]:
-            if release not in facts["iocage_releases"]:
-                release, _release_changed, _release_msg = release_fetch(module, iocage_path, update, release, components, args)
-                if _release_changed:
-                    _msg += _release_msg
-                    facts["iocage_releases"] = _get_iocage_facts(module, iocage_path, "releases")
-
-            release, changed, _msg = jail_update(module, iocage_path, name, release)
+        if actions["update"]:
+            changed, _msg = jail_update(module, iocage_path, name)
             msgs.append(_msg)
 
 #        # re-set properties (iocage missing them on creation - iocage-sh bug)
@@ -920,12 +2336,176 @@ def run_module():
             _msg = f"Jail {name} removed from iocage_templates."
             msgs.append(_msg)
 
+    elif p["state"] == "pooled":
+        members = _pool_members(jails, pool)
+        while len(members) > max(p["pool_size"], 0):
+            _member = members.pop()
+            if jails[_member]['state'] == "up":
+                changed, _msg = jail_stop(module, iocage_path, _member)
+                msgs.append(_msg)
+            _member, changed, _msg = jail_destroy(module, iocage_path, _member)
+            msgs.append(_msg)
+            del facts["iocage_jails"][_member]
+
+        # Configure the existing members like the new ones.
+        for _member in members:
+            _changed, _msg = jail_set(module, iocage_path, _member, pool_properties)
+            if _changed:
+                msgs.append(_msg)
+            if p["pool_started"] != (jails[_member]['state'] == "up"):
+                if p["pool_started"]:
+                    _changed, _msg = jail_start(module, iocage_path, _member)
+                else:
+                    _changed, _msg = jail_stop(module, iocage_path, _member)
+                    _changed = True
+                msgs.append(_msg)
+            if _changed:
+                changed = True
+                if not module.check_mode:
+                    facts["iocage_jails"][_member] = _get_iocage_facts(module, iocage_path, "jails", _member)
+
+        # In check_mode the planned names are reported, not the names returned by jail_create().
+        for _member in _pool_new_members(pool, members, p["pool_size"] - len(members)):
+            _created, changed, _msg = jail_create(module, iocage_path, _member, pool_properties,
+                                                  clone_from_template=clone_from)
+            msgs.append(_msg)
+            if p["pool_started"]:
+                _changed, _msg = jail_start(module, iocage_path, _member)
+                msgs.append(_msg)
+            members.append(_member)
+            if not module.check_mode:
+                facts["iocage_jails"][_member] = _get_iocage_facts(module, iocage_path, "jails", _member)
+        if not changed:
+            msgs.append(f"Pool {pool} already has {len(members)} member(s)")
+        extra["pool"] = dict(members=members)
+
+    elif p["state"] == "allocated":
+        if name in jails:
+            changed, _msg = jail_set(module, iocage_path, name, properties)
+            msgs.append(f"Jail {name} already allocated")
+            if changed:
+                msgs.append(_msg)
+            extra["pool"] = dict(member=None, refill=0)
+        else:
+            members = _pool_members(jails, pool)
+            if members:
+                _member = members.pop(0)
+                if jails[_member]['state'] == "up":
+                    changed, _msg = jail_stop(module, iocage_path, _member)
+                    msgs.append(_msg)
+                name, changed, _msg = jail_rename(module, iocage_path, _member, name)
+                msgs.append(_msg)
+                if not module.check_mode:
+                    del facts["iocage_jails"][_member]
+                    changed, _msg = jail_set(module, iocage_path, name, properties)
+                    msgs.append(_msg)
+            else:
+                _member = None
+                msgs.append(f"Pool {pool} is empty")
+                name, changed, _msg = jail_create(module, iocage_path, name, properties,
+                                                  clone_from_template=clone_from)
+                msgs.append(_msg)
+            changed, _msg = jail_start(module, iocage_path, name)
+            msgs.append(_msg)
+            changed = True
+            if not module.check_mode:
+                facts["iocage_jails"][name] = _get_iocage_facts(module, iocage_path, "jails", name)
+
+            _refill = _pool_new_members(pool, members + ([_member] if _member else []),
+                                        p["pool_size"] - len(members))
+            iocroot_dataset, iocroot = _get_iocroot(module, iocage_path)
+            _log = os.path.join(iocroot, "log", f"{pool}_refill.log")
+            pool_refill(module, iocage_path, clone_from, _refill, pool_properties, p["pool_started"],
+                        p["lock_file"], p["lock_timeout"], _log)
+            msgs.append(f"Pool {pool} refill of {len(_refill)} member(s) started in the background")
+            extra["pool"] = dict(member=_member, refill=len(_refill), log=_log)
+
+    elif p["state"] in ["exported", "imported"]:
+        iocroot_dataset, iocroot = _get_iocroot(module, iocage_path)
+        images = os.path.join(iocroot, "images")
+        if image_dir is None:
+            image_dir = images
+
+        if p["state"] == "exported":
+            _images = _image_list(image_dir, name)
+            if _images and not update:
+                image = _images[-1]
+                checksum = module.sha256(image)
+                msgs.append(f"Jail {name} already exported to {image}")
+            else:
+                image, checksum, changed, _msg = jail_export(module, iocage_path, name, images, image_dir)
+                msgs.append(_msg)
+
+        else:
+            if image is None:
+                _images = _image_list(image_dir, name)
+                if not _images:
+                    module.fail_json(msg=f"No image of jail {name} found in {image_dir}")
+                image = _images[-1]
+            if not os.path.isfile(image):
+                module.fail_json(msg=f"Image {image} not found")
+            if not _is_image_of(image, name):
+                module.fail_json(msg=f"Image {image} is not an image of jail {name}")
+            checksum = module.sha256(image)
+
+            do_import = True
+            if name in jails:
+                if _jail_image_checksum(module, iocroot_dataset, name) == checksum:
+                    do_import = False
+                    msgs.append(f"Jail {name} already imported from {image}")
+                elif not update:
+                    module.fail_json(msg=f"Jail {name} exists and was not imported from {image}")
+                else:
+                    if jails[name]['state'] == "up":
+                        changed, _msg = jail_stop(module, iocage_path, name)
+                        msgs.append(_msg)
+                    name, changed, _msg = jail_destroy(module, iocage_path, name)
+                    msgs.append(_msg)
+            if do_import:
+                changed, _msg = jail_import(module, iocage_path, name, image, checksum, images, iocroot_dataset)
+                msgs.append(_msg)
+                if not module.check_mode:
+                    facts["iocage_jails"][name] = _get_iocage_facts(module, iocage_path, "jails", name)
+
+        extra.update(image=image, checksum=checksum)
+
+    elif p["state"] == "reconciled":
+        try:
+            plan = reconcile_plan(iocage_path, p["spec"] or {}, facts, release, p["prune"])
+        except ValueError as e:
+            module.fail_json(msg=str(e))
+        if plan and not module.check_mode:
+            reconcile_execute(module, plan, p["concurrency"])
+            facts = _get_iocage_facts(module, iocage_path, "all")
+        changed = len(plan) > 0
+        _msg = ", ".join(f"{_action['action']} {_action['name']}" for _action in plan)
+        if module.check_mode:
+            msgs.append(f"would have executed: {_msg}" if plan else "host already reconciled")
+        else:
+            msgs.append(f"executed: {_msg}" if plan else "host already reconciled")
+        extra["plan"] = plan
+
+    elif p["state"] == "updated":
+        iocroot_dataset, iocroot = _get_iocroot(module, iocage_path)
+        if name is not None:
+            jails = {name: jails[name]}
+        changed, _msg, extra["updates"] = jails_update(module, iocage_path, iocroot, jails, p["concurrency"])
+        msgs.append(_msg)
+
+    elif p["state"] == "stats":
+        iocroot_dataset, iocroot = _get_iocroot(module, iocage_path)
+        if name is not None:
+            jails = {name: jails[name]}
+        facts["iocage_stats"] = _get_iocage_stats(module, iocage_path, jails, iocroot_dataset, p["rctl"])
+        msgs.append(f"Resource usage of {len(facts['iocage_stats'])} running jail(s) collected")
+
     result = dict(changed=changed,
                   msg=", ".join(msgs),
                   ansible_facts=facts,
                   stdout=out,
                   stderr=err,
                   )
+    result.update(extra)
     if module._debug:
         result['module_args'] = f"{(json.dumps(module.params, indent=4))}"
 
@@ -0,0 +1,38 @@
+# Parse canned output of 'jls -v --libxo=json'. Run: python -m pytest test/units
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import iocage  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def _jls(fixture):
+    with open(os.path.join(FIXTURES, fixture)) as f:
+        return f.read()
+
+
+def test_no_jails():
+    assert iocage._parse_jls(_jls('jls_empty.json')) == {}
+
+
+def test_non_iocage_jail_skipped():
+    assert iocage._parse_jls(_jls('jls_foreign.json')) == {
+        "foo": {"jid": "3", "ip4": ["10.1.0.5"], "ip6": ["fd00::5"]}}
+
+
+def test_dotted_name_by_path():
+    assert "www.example.org" in iocage._parse_jls(_jls('jls_dotted.json'))
+
+
+def test_dotted_name_by_ioc_name():
+    _running = iocage._parse_jls(_jls('jls_dotted.json'), ["db.example.org"])
+    assert _running["db.example.org"]["jid"] == "7"
+
+
+def test_unreadable():
+    with pytest.raises(ValueError):
+        iocage._parse_jls('jls: unknown option -- -')